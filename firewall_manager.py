@@ -1,33 +1,104 @@
+import glob
 import os
+import re
+import sys
+import time
 import requests
 import logging
-import smtplib
-from email.mime.text import MIMEText
+import mmap
+import orjson
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# A KEY=value line of a .env file, with the whitespace around the key and value stripped
+ENV_LINE_PATTERN = re.compile(rb'(?m)^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$')
 
 # Function to load environment variables from a .env file
 def load_env_vars(filepath):
-    """Load environment variables from a .env file."""
+    """
+    Load environment variables from a .env file.
+
+    The parsed variables are cached next to the file (e.g. `.env.cache`), keyed by
+    the modification time of the .env file, so the file is only re-parsed when it changes.
+    """
     if not os.path.isfile(filepath):
         logging.critical(f"The .env file {filepath} does not exist.")
         raise FileNotFoundError(f"The .env file {filepath} does not exist.")
-    
-    with open(filepath) as file:
-        for line in file:
-            # Strip comments and blank lines
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            # Split on '=' and strip extra spaces
-            key, value = map(str.strip, line.split('=', 1))
-            os.environ[key] = value
-            logging.debug(f"Loaded environment variable: {key}={value}")
+
+    st = os.stat(filepath)
+    mtime = str(st.st_mtime_ns).encode()
+    cache_path = f"{filepath}.cache"
+
+    # Use the cached variables if the .env file has not changed since they were written
+    try:
+        with open(cache_path, 'rb') as cache:
+            if cache.readline().strip() == mtime:
+                env = orjson.loads(cache.read())
+                os.environ.update(env)
+                return
+    except (OSError, orjson.JSONDecodeError):
+        pass
+
+    env = {}
+    # mmap cannot map an empty file
+    if st.st_size:
+        # Match all KEY=value lines in one pass; comments and blank lines never match
+        with open(filepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for key, value in ENV_LINE_PATTERN.findall(mm):
+                env[key.decode()] = value.decode()
+
+    # Set all variables at once rather than one putenv per line
+    os.environ.update(env)
+
+    # Write the cache atomically so a partial write is never read back
+    tmp_path = f"{cache_path}.tmp"
+    try:
+        # The cache holds the same secrets as the .env file, keep it private to the owner
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as cache:
+            cache.write(mtime + b"\n")
+            cache.write(orjson.dumps(env))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Failed to write .env cache {cache_path}: {e}")
+
+# Configure the log file before anything is logged, the level is set once the .env file is loaded
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', filename="meow.txt")
 
 # Load environment variables from .env file
 load_env_vars('.env')
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', filename="meow.txt")
+# Settings read once from the environment
+VERBOSE = os.getenv("FIREWALL_MANAGER_VERBOSE", "0") == "1"
+HETZNER_API_TOKEN = os.getenv("HETZNER_API_TOKEN")
+FIREWALL_ID = os.getenv("FIREWALL_ID")
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+NOTIFY_EMAIL = os.getenv("NOTIFY_EMAIL")
+EMAIL_SPOOL_FILE = os.getenv("EMAIL_SPOOL_FILE")
+
+# Debug output is only written in verbose mode
+logging.getLogger().setLevel(logging.DEBUG if VERBOSE else logging.INFO)
+
+# Shared HTTP session so connections (and TLS handshakes) are reused between requests
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+def redact_headers(headers):
+    """
+    Hides the authorization token in request headers so they can be logged.
+    
+    Args:
+        headers (dict): The request headers.
+    
+    Returns:
+        dict: A copy of the headers with the Authorization value redacted.
+    """
+    return {key: "<redacted>" if key.lower() == "authorization" else value for key, value in headers.items()}
 
 def get_my_ipv4():
     """
@@ -37,14 +108,18 @@ def get_my_ipv4():
         str: The public IPv4 address.
     """
     try:
-        response = requests.get("https://api.ipify.org?format=json")
-        logging.debug(f"GET https://api.ipify.org?format=json")
+        response = SESSION.get("https://api.ipify.org?format=json")
+        logging.debug("GET https://api.ipify.org?format=json")
         response.raise_for_status()
-        ip_address = response.json().get("ip")
-        logging.debug(f"Response JSON: {response.json()}")
+        body = orjson.loads(response.content)
+        ip_address = body.get("ip")
+        logging.debug("Response JSON: %s", body)
+        if not ip_address:
+            logging.error("Failed to fetch IP address: no IP address in the response.")
+            exit(1)
         logging.info(f"Successfully retrieved your public IP address: {ip_address}.")
         return ip_address
-    except requests.RequestException as e:
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logging.error(f"Failed to fetch IP address: {e}")
         exit(1)
 
@@ -61,14 +136,15 @@ def get_current_firewall_rules(firewall_id, headers):
     """
     try:
         url = f"https://api.hetzner.cloud/v1/firewalls/{firewall_id}"
-        logging.debug(f"GET {url} with headers {headers}")
-        response = requests.get(url, headers=headers)
+        logging.debug("GET %s with headers %s", url, redact_headers(headers))
+        response = SESSION.get(url, headers=headers)
         response.raise_for_status()
-        rules = response.json().get('firewall', {}).get('rules', [])
-        logging.debug(f"Response JSON: {response.json()}")
+        body = orjson.loads(response.content)
+        rules = body.get('firewall', {}).get('rules', [])
+        logging.debug("Response JSON: %s", body)
         logging.info(f"Retrieved {len(rules)} firewall rules.")
         return rules
-    except requests.RequestException as e:
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logging.error(f"Failed to fetch firewall rules: {e}")
         exit(1)
         
@@ -114,16 +190,16 @@ def update_firewall_rules(firewall_id, headers, rules):
     rules = remove_duplicate_rules(rules)
     
     data = {"rules": rules}
-    logging.debug(f"POST {api_url} with headers {headers} and data {data}")
+    logging.debug("POST %s with headers %s and data %s", api_url, redact_headers(headers), data)
 
     try:
-        response = requests.post(api_url, headers=headers, json=data)
+        response = SESSION.post(api_url, headers={**headers, "Content-Type": "application/json"}, data=orjson.dumps(data))
         if response.status_code == 200:
             return True
         
         response.raise_for_status()  # Raises HTTPError for bad responses
-        response_json = response.json()
-        logging.debug(f"Response JSON: {response_json}")
+        response_json = orjson.loads(response.content)
+        logging.debug("Response JSON: %s", response_json)
 
         # Check actions status
         actions = response_json.get('actions', [])
@@ -146,7 +222,7 @@ def update_firewall_rules(firewall_id, headers, rules):
             logging.error("Failed to update firewall rules. Some actions did not succeed.")
             return False
 
-    except requests.RequestException as e:
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         # Handle cases where the request fails
         logging.error(f"Failed to update firewall rules: {e}")
         if 'response' in locals() and response.content:
@@ -158,13 +234,24 @@ def send_email_notification(subject, body, to_email):
     """
     Sends an email notification with a subject and body.
     
+    If `EMAIL_SPOOL_FILE` is set, the notification is appended to the spool file
+    instead and sent later by `flush_email_spool`.
+    
     Args:
         subject (str): The subject of the email.
         body (str): The body content of the email.
         to_email (str): The recipient's email address.
     """
-    from_email = os.getenv("EMAIL_ADDRESS")
-    password = os.getenv("EMAIL_PASSWORD")
+    if EMAIL_SPOOL_FILE:
+        spool_email_notification(subject, body, to_email)
+        return
+
+    # Imported here since email is only sent when the firewall rules change
+    import smtplib
+    from email.mime.text import MIMEText
+
+    from_email = EMAIL_ADDRESS
+    password = EMAIL_PASSWORD
     
     msg = MIMEText(body)
     msg["Subject"] = subject
@@ -172,7 +259,7 @@ def send_email_notification(subject, body, to_email):
     msg["To"] = to_email
 
     try:
-        logging.debug(f"Sending email to {to_email} from {from_email} with subject {subject}")
+        logging.debug("Sending email to %s from %s with subject %s", to_email, from_email, subject)
         with smtplib.SMTP_SSL("mail3.luova.club", 465) as server:
             server.login(from_email, password)
             server.sendmail(from_email, to_email, msg.as_string())
@@ -180,6 +267,178 @@ def send_email_notification(subject, body, to_email):
     except Exception as e:
         logging.error(f"Failed to send email notification: {e}")
 
+def spool_email_notification(subject, body, to_email):
+    """
+    Appends an email notification to the spool file to be sent later.
+    
+    Args:
+        subject (str): The subject of the email.
+        body (str): The body content of the email.
+        to_email (str): The recipient's email address.
+    """
+    entry = {"subject": subject, "body": body, "to_email": to_email, "timestamp": time.time()}
+    try:
+        with open(EMAIL_SPOOL_FILE, 'ab') as f:
+            f.write(orjson.dumps(entry) + b"\n")
+        logging.info(f"Notification email to {to_email} spooled to {EMAIL_SPOOL_FILE}.")
+    except OSError as e:
+        logging.error(f"Failed to spool email notification: {e}")
+
+def read_email_spool(spool_file, bad_file):
+    """
+    Reads the email notifications queued in a spool file.
+    
+    Lines that cannot be parsed or are not valid notifications, e.g. left behind by an
+    interrupted append, are moved to the bad file instead of blocking the rest of the spool.
+    
+    Args:
+        spool_file (str): The path of the spool file.
+        bad_file (str): The path of the file collecting unusable notifications.
+    
+    Returns:
+        list: The queued notifications, or an empty list if the file does not exist.
+    """
+    try:
+        with open(spool_file, 'rb') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    entries = []
+    bad_lines = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entry = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            entry = None
+        if not is_valid_spooled_email(entry):
+            bad_lines.append(line if line.endswith(b"\n") else line + b"\n")
+            continue
+        entries.append(entry)
+
+    if bad_lines:
+        with open(bad_file, 'ab') as f:
+            f.writelines(bad_lines)
+        logging.error(f"Moved {len(bad_lines)} malformed spooled email notifications from {spool_file} to {bad_file}.")
+    return entries
+
+def is_valid_spooled_email(entry):
+    """
+    Checks that a spooled email notification has everything needed to send it.
+    
+    Args:
+        entry: The decoded spool line.
+    
+    Returns:
+        bool: True if the notification can be sent, False otherwise.
+    """
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get("subject"), str)
+        and isinstance(entry.get("body"), str)
+        and isinstance(entry.get("to_email"), str)
+        and bool(entry["to_email"])
+        and isinstance(entry.get("timestamp", 0), (int, float))
+    )
+
+def write_email_spool(spool_file, entries):
+    """
+    Atomically replaces a spool file with the given email notifications.
+    
+    Args:
+        spool_file (str): The path of the spool file.
+        entries (list): The notifications to keep, the file is removed if this is empty.
+    """
+    if not entries:
+        try:
+            os.remove(spool_file)
+        except FileNotFoundError:
+            pass
+        return
+
+    tmp_file = f"{spool_file}.tmp"
+    with open(tmp_file, 'wb') as f:
+        for entry in entries:
+            f.write(orjson.dumps(entry) + b"\n")
+    os.replace(tmp_file, spool_file)
+
+def flush_email_spool():
+    """
+    Sends all spooled email notifications using a single SMTP connection.
+    
+    The spool file is moved to its own `<EMAIL_SPOOL_FILE>.<time>.sending` batch before
+    sending, so notifications spooled meanwhile go to a new file. Batches are never merged,
+    so a crash cannot make a notification appear in two of them. Batches left over from an
+    earlier failed flush are sent first. A notification the server refuses is moved to
+    `<EMAIL_SPOOL_FILE>.bad`; only a connection or login failure keeps the rest for the next flush.
+    """
+    if not EMAIL_SPOOL_FILE:
+        logging.error("EMAIL_SPOOL_FILE is not set, there is no spool to flush.")
+        return
+
+    bad_file = f"{EMAIL_SPOOL_FILE}.bad"
+    try:
+        os.replace(EMAIL_SPOOL_FILE, f"{EMAIL_SPOOL_FILE}.{time.time_ns()}.sending")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f"Failed to move the email spool {EMAIL_SPOOL_FILE} aside: {e}")
+
+    batches = []
+    for batch_file in sorted(glob.glob(f"{glob.escape(EMAIL_SPOOL_FILE)}.*.sending")):
+        try:
+            batches.append((batch_file, read_email_spool(batch_file, bad_file)))
+        except OSError as e:
+            logging.error(f"Failed to read the email spool {batch_file}: {e}")
+
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.utils import formatdate
+
+    from_email = EMAIL_ADDRESS
+    password = EMAIL_PASSWORD
+
+    total = sum(len(entries) for _, entries in batches)
+    done = {batch_file: 0 for batch_file, _ in batches}
+    sent = 0
+    if total:
+        try:
+            with smtplib.SMTP_SSL("mail3.luova.club", 465) as server:
+                server.login(from_email, password)
+                for batch_file, entries in batches:
+                    for entry in entries:
+                        try:
+                            msg = MIMEText(entry["body"])
+                            msg["Subject"] = entry["subject"]
+                            msg["From"] = from_email
+                            msg["To"] = entry["to_email"]
+                            # Date the email when it was spooled, not when the spool is flushed
+                            msg["Date"] = formatdate(entry.get("timestamp"), localtime=True)
+                            logging.debug("Sending spooled email to %s with subject %s", entry["to_email"], entry["subject"])
+                            server.sendmail(from_email, entry["to_email"], msg.as_string())
+                            sent += 1
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, TypeError, ValueError) as e:
+                            # This notification will never go through, set it aside so it does not block the others
+                            logging.error(f"Failed to send spooled email to {entry['to_email']}, moving it to {bad_file}: {e}")
+                            with open(bad_file, 'ab') as f:
+                                f.write(orjson.dumps(entry) + b"\n")
+                        done[batch_file] += 1
+        except Exception as e:
+            logging.error(f"Failed to send spooled email notifications: {e}")
+    else:
+        logging.info("No spooled email notifications to send.")
+
+    # Keep only the notifications that were not handled so they are not sent twice
+    for batch_file, entries in batches:
+        try:
+            write_email_spool(batch_file, entries[done[batch_file]:])
+        except OSError as e:
+            logging.error(f"Failed to update the email spool {batch_file}: {e}")
+    if total:
+        logging.info(f"Sent {sent} of {total} spooled email notifications.")
+
 def interactive_mode(current_rules, new_rule):
     """
     Allows the user to interactively approve each step before proceeding.
@@ -197,7 +456,7 @@ def interactive_mode(current_rules, new_rule):
     print("New rule to be added:")
     print(new_rule)
     confirm = input("Do you want to proceed with adding this rule? (yes/no): ")
-    logging.debug(f"User confirmation for new rule: {confirm}")
+    logging.debug("User confirmation for new rule: %s", confirm)
     return confirm.lower() == 'yes'
 
 def track_ip_file():
@@ -216,39 +475,97 @@ def get_last_ip():
     Returns:
         str: The last used IP address, or None if the file does not exist.
     """
-    if os.path.exists(track_ip_file()):
-        with open(track_ip_file(), 'r') as f:
-            last_ip = f.read().strip()
-        logging.debug(f"Last IP retrieved from file: {last_ip}")
-        return last_ip
-    logging.debug("No last IP file found.")
-    return None
+    try:
+        with open(track_ip_file(), 'rb') as f:
+            last_ip = f.read().strip().decode()
+    except FileNotFoundError:
+        logging.debug("No last IP file found.")
+        return None
+    logging.debug("Last IP retrieved from file: %s", last_ip)
+    return last_ip
 
 def set_last_ip(ip_address):
     """
     Sets the current IP address as the last used IP address in a file.
     
+    The address is written to a temporary file which then replaces the tracking file,
+    so an interrupted write never leaves a corrupted file behind.
+    
     Args:
         ip_address (str): The IP address to be stored.
     """
-    with open(track_ip_file(), 'w') as f:
+    tmp_file = f"{track_ip_file()}.tmp"
+    with open(tmp_file, 'w') as f:
         f.write(ip_address)
-    logging.debug(f"Set last IP address in file: {ip_address}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, track_ip_file())
+    logging.debug("Set last IP address in file: %s", ip_address)
+
+def rule_key(rule):
+    """
+    Builds the key used to index a firewall rule.
+    
+    Args:
+        rule (dict): The firewall rule.
+    
+    Returns:
+        tuple: The (direction, port, protocol) of the rule.
+    """
+    return (rule.get('direction'), rule.get('port'), rule.get('protocol'))
 
-def remove_ip_rule(rules, ip_to_remove):
+def index_rules(rules):
     """
-    Removes a rule that allows a specific IP address from the firewall rules.
+    Indexes the firewall rules by their (direction, port, protocol).
+    
+    Args:
+        rules (list): The firewall rules.
+    
+    Returns:
+        defaultdict: A mapping of rule keys to the list of rules with that key.
+    """
+    rule_index = defaultdict(list)
+    for rule in rules:
+        rule_index[rule_key(rule)].append(rule)
+    return rule_index
+
+def remove_ip_rule(rules, ip_to_remove, rule_index=None, key=None):
+    """
+    Removes a specific IP address from the source IPs of the firewall rules.
+    
+    The IP address is removed from each rule's `source_ips`; a rule is only dropped
+    when the removed IP address was its last source IP. When a rule index and key are
+    given, only the rules indexed under that key are considered.
     
     Args:
         rules (list): The current firewall rules.
         ip_to_remove (str): The IP address to be removed from the rules.
+        rule_index (dict, optional): The rules indexed by `index_rules`.
+        key (tuple, optional): The (direction, port, protocol) of the rules to update.
     
     Returns:
         list: The updated list of firewall rules.
     """
-    updated_rules = [rule for rule in rules if ip_to_remove not in rule.get('source_ips', [])]
-    logging.debug(f"Removed IP {ip_to_remove} from rules. Updated rules: {updated_rules}")
-    return updated_rules
+    candidates = rules if rule_index is None else rule_index.get(key, [])
+    emptied_rules = set()
+    for rule in candidates:
+        ips = rule.get('source_ips')
+        if not ips:
+            continue
+        try:
+            ips.remove(ip_to_remove)
+        except ValueError:
+            continue
+        if not ips:
+            # The removed IP was the only source of this rule, drop the rule
+            emptied_rules.add(id(rule))
+
+    if emptied_rules:
+        rules = [rule for rule in rules if id(rule) not in emptied_rules]
+        if rule_index is not None:
+            rule_index[key] = [rule for rule in rule_index[key] if id(rule) not in emptied_rules]
+    logging.debug("Removed IP %s from rules. Updated rules: %s", ip_to_remove, rules)
+    return rules
 
 def restore_firewall_rules(firewall_id, headers):
     """
@@ -261,9 +578,9 @@ def restore_firewall_rules(firewall_id, headers):
     logging.error("Restoring previous firewall rules is not implemented.")
 
 def main():
-    # Load API token and firewall ID from environment variables
-    api_token = os.getenv("HETZNER_API_TOKEN")
-    firewall_id = os.getenv("FIREWALL_ID")
+    # API token and firewall ID loaded from environment variables
+    api_token = HETZNER_API_TOKEN
+    firewall_id = FIREWALL_ID
     
     if not api_token or not firewall_id:
         logging.critical("API token or firewall ID not found in environment variables.")
@@ -274,33 +591,53 @@ def main():
         "Authorization": f"Bearer {api_token}",
         "Content-Type": "application/json"
     }
-    logging.debug(f"API headers: {headers}")
+    logging.debug("API headers: %s", redact_headers(headers))
 
     # Get the current public IP and convert it to CIDR notation
     my_ip_address = get_my_ipv4()
     cidr_ip = f"{my_ip_address}/32"
-    logging.debug(f"Current IP in CIDR notation: {cidr_ip}")
-    
-    # Fetch current firewall rules
-    current_rules = get_current_firewall_rules(firewall_id, headers)
+    logging.debug("Current IP in CIDR notation: %s", cidr_ip)
     
     # Retrieve the last used IP address
     last_ip_address = get_last_ip()
     
-    if last_ip_address and last_ip_address != my_ip_address:
-        # Remove old IP rule
-        current_rules = remove_ip_rule(current_rules, f"{last_ip_address}/32")
-        logging.info(f"Old IP address ({last_ip_address}) removed from firewall rules.")
+    # Nothing to do if the IP has not changed since the last successful update
+    if last_ip_address == my_ip_address:
+        logging.info("IP unchanged; nothing to do.")
+        return
+    
+    # Fetch current firewall rules and index them by (direction, port, protocol)
+    current_rules = get_current_firewall_rules(firewall_id, headers)
+    rule_index = index_rules(current_rules)
     
-    # Add the new rule to allow the current IP
+    # The rule allowing the current IP
     new_rule = {
         "direction": "in",
         "source_ips": [cidr_ip],
         "port": "22017",
         "protocol": "tcp"
     }
-    current_rules.append(new_rule)
-    logging.debug(f"New rule to be added: {new_rule}")
+    new_rule_key = rule_key(new_rule)
+    
+    if last_ip_address:
+        # Remove old IP rule
+        last_cidr_ip = f"{last_ip_address}/32"
+        current_rules = remove_ip_rule(current_rules, last_cidr_ip, rule_index, new_rule_key)
+        logging.info(f"Old IP address ({last_ip_address}) removed from firewall rules.")
+    
+    # Merge the IP into an existing rule for the same direction, port and protocol
+    # instead of appending another rule object
+    matching_rules = rule_index[new_rule_key]
+    if matching_rules:
+        rule = matching_rules[0]
+        source_ips = rule.get('source_ips', [])
+        if cidr_ip not in source_ips:
+            rule['source_ips'] = sorted(set(source_ips) | {cidr_ip})
+        logging.debug("Merged %s into existing rule: %s", cidr_ip, rule)
+    else:
+        current_rules.append(new_rule)
+        matching_rules.append(new_rule)
+        logging.debug("New rule to be added: %s", new_rule)
     
     # Update the firewall with the new set of rules
     if update_firewall_rules(firewall_id, headers, current_rules):
@@ -311,7 +648,7 @@ def main():
         send_email_notification(
             "Firewall Rules Updated",
             f"Your IP address has been updated to {my_ip_address}.",
-            os.getenv("NOTIFY_EMAIL")
+            NOTIFY_EMAIL
         )
     else:
         logging.error(f"Failed to update firewall rules. Attempting to restore previous state.")
@@ -319,5 +656,8 @@ def main():
 
 if __name__ == "__main__":
     logging.info("Starting script execution.")
-    main()
+    if "--flush-email-spool" in sys.argv[1:]:
+        flush_email_spool()
+    else:
+        main()
     logging.info("Script execution completed.")